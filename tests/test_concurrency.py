@@ -1,7 +1,7 @@
 import numpy as np
 import pytest
 
-from warpkit.concurrency import run_executor
+from warpkit.concurrency import create_executor, run_executor
 
 
 # define a test function
@@ -28,3 +28,10 @@ def test_run_executor():
     assert np.all(result_array == np.arange(10) + 1)
     run_executor(2, "process", dummy_fn, test_iterator(10), post_fn=test_post_fn)
     assert np.all(result_array == np.arange(10) + 1)
+
+    # reuse an existing executor across multiple calls
+    with create_executor(2, "process") as executor:
+        for _ in range(2):
+            result_array[:] = 0
+            run_executor(2, "process", dummy_fn, test_iterator(10), post_fn=test_post_fn, executor=executor)
+            assert np.all(result_array == np.arange(10) + 1)
@@ -1,5 +1,10 @@
+from multiprocessing import get_context
+
+import nibabel as nib
 import numpy as np
+import pytest
 
+from warpkit import distortion
 from warpkit.distortion import medic
 
 from . import bids_test_data
@@ -21,3 +26,137 @@ def test_medic(bids_test_data):
         corr = np.corrcoef(frame1.ravel(), framei.ravel())[0, 1]
         print(corr)
         assert corr > 0.98, f"Correlation between frame 1 and frame {i} is only {corr} < 0.98"
+
+
+def test_medic_chunk_size(bids_test_data):
+    # converting/inverting the field maps one frame at a time should give the same result as a single chunk
+    frames = [0, 1, 2]
+    outputs = medic(**bids_test_data, frames=frames, n_cpus=1)
+    outputs_chunked = medic(**bids_test_data, frames=frames, n_cpus=1, chunk_size=1)
+    for img, img_chunked in zip(outputs, outputs_chunked):
+        assert img.shape[-1] == len(frames)
+        assert np.allclose(img.get_fdata(), img_chunked.get_fdata())
+
+    # chunk size must be positive
+    with pytest.raises(ValueError):
+        medic(**bids_test_data, n_cpus=1, chunk_size=0)
+
+
+def test_medic_cache_field_maps(bids_test_data, monkeypatch):
+    # count the number of times the field maps are computed
+    n_calls = []
+    unwrap = distortion.unwrap_and_compute_field_maps
+
+    def counted_unwrap(*args, **kwargs):
+        n_calls.append(1)
+        return unwrap(*args, **kwargs)
+
+    monkeypatch.setattr(distortion, "unwrap_and_compute_field_maps", counted_unwrap)
+    distortion.clear_field_map_cache()
+
+    frames = [0, 1]
+    fmaps_native, dmaps, _ = medic(**bids_test_data, frames=frames, n_cpus=1, cache_field_maps=True)
+    assert len(n_calls) == 1
+
+    # changes to the returned image should not leak into the cache
+    np.asanyarray(fmaps_native.dataobj)[:] = 0
+    fmaps_native.set_data_dtype(np.int16)
+
+    # a different total readout time should reuse the cached field maps
+    inputs = {**bids_test_data, "total_readout_time": bids_test_data["total_readout_time"] * 2}
+    fmaps_native2, dmaps2, _ = medic(**inputs, frames=frames, n_cpus=1, cache_field_maps=True)
+    assert len(n_calls) == 1
+    assert fmaps_native2.get_data_dtype() != np.int16
+    assert not np.allclose(fmaps_native2.get_fdata(), 0)
+    assert not np.allclose(dmaps.get_fdata(), dmaps2.get_fdata())
+
+    # frames given as an array should hit the same cache entry
+    medic(**inputs, frames=np.arange(2), n_cpus=1, cache_field_maps=True)
+    assert len(n_calls) == 1
+
+    # the same values should be returned as without the cache
+    fmaps_native3, _, _ = medic(**inputs, frames=frames, n_cpus=1)
+    assert len(n_calls) == 2
+    assert np.allclose(fmaps_native2.get_fdata(), fmaps_native3.get_fdata())
+
+    # clearing the cache forces a recompute
+    distortion.clear_field_map_cache()
+    medic(**inputs, frames=frames, n_cpus=1, cache_field_maps=True)
+    assert len(n_calls) == 3
+    distortion.clear_field_map_cache()
+
+
+def test_medic_frames(bids_test_data):
+    # process a non-contiguous subset of frames
+    frames = [3, 1]
+    outputs = medic(**bids_test_data, frames=frames, n_cpus=1)
+    for img in outputs:
+        assert img.shape[-1] == len(frames)
+
+    # a single frame from the 4D data should match running on the equivalent 3D data
+    fmaps_native_4d, _, _ = medic(**bids_test_data, frames=[3], n_cpus=1)
+    data_3d = {
+        **bids_test_data,
+        "phase": [p.slicer[..., 3] for p in bids_test_data["phase"]],
+        "mag": [m.slicer[..., 3] for m in bids_test_data["mag"]],
+    }
+    assert len(data_3d["phase"][0].shape) == 3
+    outputs_3d = medic(**data_3d, n_cpus=1)
+    for img in outputs_3d:
+        assert img.shape == (*data_3d["phase"][0].shape, 1)
+    assert np.allclose(fmaps_native_4d.get_fdata(), outputs_3d[0].get_fdata(), atol=1e-3)
+
+
+def _medic_multiple_cpus(bids_test_data):
+    # a single frame run should not start a JuliaContext in this process, or the next run would crash when forking
+    outputs = medic(**bids_test_data, frames=[0], n_cpus=2)
+    for img in outputs:
+        assert img.shape[-1] == 1
+    frames = [0, 1, 2]
+    outputs = medic(**bids_test_data, frames=frames, n_cpus=2)
+    for img in outputs:
+        assert img.shape[-1] == len(frames)
+
+
+def test_medic_multiple_cpus(bids_test_data):
+    # run in a fresh process, since the other tests have already started a JuliaContext in this one
+    process = get_context("spawn").Process(target=_medic_multiple_cpus, args=(bids_test_data,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def test_medic_mask(bids_test_data):
+    # use a user supplied mask instead of the automask
+    mag_data = np.asanyarray(bids_test_data["mag"][0].dataobj)
+    mask = nib.Nifti1Image((mag_data > mag_data.mean()).astype(np.int8), bids_test_data["mag"][0].affine)
+    frames = [0, 1]
+    outputs = medic(**bids_test_data, frames=frames, n_cpus=1, mask=mask, automask=False)
+    for img in outputs:
+        assert img.shape[-1] == len(frames)
+        assert np.all(np.isfinite(img.get_fdata()))
+
+    # the mask should be promoted along with the 3D phase and magnitude data
+    data_3d = {
+        **bids_test_data,
+        "phase": [p.slicer[..., 3] for p in bids_test_data["phase"]],
+        "mag": [m.slicer[..., 3] for m in bids_test_data["mag"]],
+    }
+    outputs_3d = medic(**data_3d, n_cpus=1, mask=mask.slicer[..., 3], automask=False)
+    for img in outputs_3d:
+        assert img.shape == (*data_3d["phase"][0].shape, 1)
+        assert np.all(np.isfinite(img.get_fdata()))
+
+    # the mask must be on the same grid as the phase images
+    with pytest.raises(ValueError):
+        medic(**bids_test_data, frames=frames, n_cpus=1, mask=mask.slicer[..., 3], automask=False)
+    shifted_affine = mask.affine.copy()
+    shifted_affine[:3, 3] += 10
+    with pytest.raises(ValueError):
+        medic(
+            **bids_test_data,
+            frames=frames,
+            n_cpus=1,
+            mask=nib.Nifti1Image(np.asanyarray(mask.dataobj), shifted_affine),
+            automask=False,
+        )
@@ -0,0 +1,27 @@
+import numpy as np
+
+from warpkit.unwrap import unwrap_phase_dct_wls
+
+
+def test_unwrap_phase_dct_wls():
+    # make a smooth phase volume that wraps several times
+    x, y, z = np.meshgrid(np.linspace(-1, 1, 32), np.linspace(-1, 1, 32), np.linspace(-1, 1, 24), indexing="ij")
+    r2 = x**2 + y**2 + z**2
+    true_phase = (20 * np.exp(-r2 / 0.2) + 6 * x).astype(np.float32)
+    wrapped_phase = np.angle(np.exp(1j * true_phase)).astype(np.float32)
+
+    # fill voxels outside of the mask with noise, these should be ignored through the weights
+    mask = r2 < 0.7
+    rng = np.random.default_rng(0)
+    wrapped_phase[~mask] = rng.uniform(-np.pi, np.pi, np.count_nonzero(~mask))
+
+    # unwrap
+    unwrapped = unwrap_phase_dct_wls(wrapped_phase, mask.astype(np.float32))
+
+    # solution should be congruent with the wrapped phase
+    assert np.allclose(np.angle(np.exp(1j * (unwrapped - wrapped_phase))), 0, atol=1e-4)
+
+    # and match the true phase in the mask up to a global multiple of 2 pi
+    diff = (unwrapped - true_phase)[mask]
+    diff -= 2 * np.pi * np.round(np.median(diff) / (2 * np.pi))
+    assert np.allclose(diff, 0, atol=1e-3)
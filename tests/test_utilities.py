@@ -1,7 +1,9 @@
+import nibabel as nib
 import numpy as np
 from numpy.testing import assert_allclose
 
-from warpkit.utilities import corr2_coeff
+from warpkit.concurrency import create_executor
+from warpkit.utilities import affines_match, corr2_coeff, invert_displacement_maps
 
 
 def test_corr2_coeff():
@@ -25,3 +27,35 @@ def test_corr2_coeff():
     for i in range(size):
         C[i] = np.corrcoef(B[:, 0], A[:, i])[0, 1]
     assert_allclose(corr2_coeff(B, A).ravel(), C)
+
+
+def test_affines_match():
+    data = np.zeros((2, 2, 2), dtype=np.float32)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+
+    # matching affines (including within tolerance) should match
+    imgs = [nib.Nifti1Image(data, affine), nib.Nifti1Image(data, affine + 1e-9)]
+    assert affines_match(imgs)
+
+    # mismatched affines should not match
+    shifted_affine = affine.copy()
+    shifted_affine[:3, 3] = 1
+    imgs.append(nib.Nifti1Image(data, shifted_affine))
+    assert not affines_match(imgs)
+    assert affines_match(imgs, atol=2)
+
+
+def test_invert_displacement_maps_parallel():
+    # make a small smooth synthetic displacement map along y
+    x, y, z = np.meshgrid(np.linspace(-1, 1, 12), np.linspace(-1, 1, 12), np.linspace(-1, 1, 8), indexing="ij")
+    data = np.stack([(t + 1) * np.exp(-(x**2 + y**2 + z**2) / 0.5) for t in range(3)], axis=-1).astype(np.float32)
+    displacement_maps = nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0]))
+
+    # inverting frames in parallel (or on a reused pool) should match the serial result
+    serial = invert_displacement_maps(displacement_maps, "y", n_cpus=1).get_fdata()
+    parallel = invert_displacement_maps(displacement_maps, "y", n_cpus=2).get_fdata()
+    assert_allclose(serial, parallel)
+    with create_executor(2, "process") as executor:
+        for _ in range(2):
+            reused = invert_displacement_maps(displacement_maps, "y", executor=executor).get_fdata()
+            assert_allclose(serial, reused)
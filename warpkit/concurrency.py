@@ -34,6 +34,40 @@ class DummyExecutor(Executor):
             self._shutdown = True
 
 
+def create_executor(ncpus: int, type: str, initializer: Optional[Callable] = None) -> Executor:
+    """Creates an executor with given number of cpus and type of executor.
+
+    If `ncpus` is set to 1, then the executor will be a DummyExecutor, which will run
+    submitted functions in the current thread. Otherwise, the `type` of executor can be set
+    to either "thread" or "process", which will create a ThreadPoolExecutor or
+    ProcessPoolExecutor, respectively.
+
+    Parameters
+    ----------
+    ncpus : int
+        Number of cpus to use.
+    type : str
+        Type of executor to use. Can be either "thread" or "process".
+    initializer : Callable, optional
+        Function to call to initialize the executor.
+
+    Returns
+    -------
+    Executor
+        The created executor
+    """
+    if ncpus == 1:
+        if initializer is not None:
+            initializer()
+        return DummyExecutor()
+    elif type == "thread":
+        return ThreadPoolExecutor(ncpus, initializer=initializer)
+    elif type == "process":
+        return ProcessPoolExecutor(ncpus, initializer=initializer)
+    else:
+        raise ValueError("type must be either 'thread' or 'process'")
+
+
 def run_executor(
     ncpus: int,
     type: str,
@@ -41,6 +75,7 @@ def run_executor(
     iterator: Iterator,
     initializer: Optional[Callable] = None,
     post_fn: Optional[Callable] = None,
+    executor: Optional[Executor] = None,
 ):
     """Runs executor with given number of cpus and type of executor.
 
@@ -69,18 +104,15 @@ def run_executor(
         Function to call to initialize the executor.
     post_fn : Callable, optional
         Function to call after future has been unpacked.
+    executor : Executor, optional
+        An existing executor to run the jobs on (e.g. from `create_executor`), so it can be reused
+        across calls. If given, `ncpus`, `type` and `initializer` are ignored and the executor is
+        not shut down by this function.
     """
-    # Create executor
-    if ncpus == 1:
-        if initializer is not None:
-            initializer()
-        executor = DummyExecutor()
-    elif type == "thread":
-        executor = ThreadPoolExecutor(ncpus, initializer=initializer)
-    elif type == "process":
-        executor = ProcessPoolExecutor(ncpus, initializer=initializer)
-    else:
-        raise ValueError("type must be either 'thread' or 'process'")
+    # Create executor (unless one was given)
+    owns_executor = executor is None
+    if executor is None:
+        executor = create_executor(ncpus, type, initializer)
 
     # Create dict to store futures
     futures = dict()
@@ -97,5 +129,6 @@ def run_executor(
         if post_fn is not None:
             post_fn(idx, future.result())
 
-    # Shutdown executor
-    executor.shutdown()
+    # Shutdown executor (if we created it)
+    if owns_executor:
+        executor.shutdown()
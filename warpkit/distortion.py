@@ -1,20 +1,68 @@
+import logging
+import os
+from collections import OrderedDict
 from typing import List, Optional, Tuple, Union
 
 import nibabel as nib
 import numpy as np
+import numpy.typing as npt
 
+from warpkit.concurrency import create_executor
 from warpkit.unwrap import unwrap_and_compute_field_maps
 from warpkit.utilities import (
+    affines_match,
     displacement_maps_to_field_maps,
     field_maps_to_displacement_maps,
     invert_displacement_maps,
 )
 
+# cache of recently computed (distorted space) field maps, so repeated medic calls on the same data
+# (e.g. when only the readout time/phase encoding direction changes) can skip the phase unwrapping
+# this is only used when medic is called with cache_field_maps=True
+FMAP_CACHE_SIZE = 4
+_FMAP_CACHE: "OrderedDict[tuple, nib.Nifti1Image]" = OrderedDict()
+
+
+def clear_field_map_cache() -> None:
+    """Clear the field maps cached by medic (with cache_field_maps=True), freeing their memory."""
+    _FMAP_CACHE.clear()
+
+
+def _copy_image(img: nib.Nifti1Image) -> nib.Nifti1Image:
+    """Copy an image (data and header), so changes to the copy don't affect the original."""
+    return nib.Nifti1Image(np.array(img.dataobj), img.affine, img.header)
+
+
+def _field_map_cache_key(
+    phase: List[nib.Nifti1Image],
+    mag: List[nib.Nifti1Image],
+    TEs: Union[List[float], Tuple[float], npt.NDArray[np.float32]],
+    mask: Optional[nib.Nifti1Image],
+    **kwargs,
+) -> Optional[tuple]:
+    """Build a key identifying a field map computation, or None if the inputs can't be identified.
+
+    Images are identified by their file on disk (path and modification time), so images that only
+    exist in memory (which may have been modified) are never cached.
+    """
+    images = [*phase, *mag] if mask is None else [*phase, *mag, mask]
+    image_keys = []
+    for img in images:
+        filename = img.get_filename()
+        if filename is None:
+            return None
+        image_keys.append((os.path.abspath(filename), os.stat(filename).st_mtime_ns, img.shape, img.affine.tobytes()))
+    return (
+        tuple(image_keys),
+        tuple(float(te) for te in TEs),
+        tuple((k, tuple(v) if isinstance(v, (list, tuple)) else v) for k, v in sorted(kwargs.items())),
+    )
+
 
 def medic(
     phase: List[nib.Nifti1Image],
     mag: List[nib.Nifti1Image],
-    TEs: Union[List[float], Tuple[float]],
+    TEs: Union[List[float], Tuple[float], npt.NDArray[np.float32]],
     total_readout_time: float,
     phase_encoding_direction: str,
     frames: Optional[List[int]] = None,
@@ -24,6 +72,11 @@ def medic(
     n_cpus: int = 4,
     debug: bool = False,
     wrap_limit: bool = False,
+    mask: Optional[nib.Nifti1Image] = None,
+    automask: bool = True,
+    unwrap_method: str = "romeo",
+    chunk_size: int = 32,
+    cache_field_maps: bool = False,
 ) -> Tuple[nib.Nifti1Image, nib.Nifti1Image, nib.Nifti1Image]:
     """This runs Multi-Echo DIstortion Correction (MEDIC) on a set of phase and magnitude images.
 
@@ -35,13 +88,18 @@ def medic(
     Phase Unwrapping with a Rapid Opensource Minimum Spanning TreE AlgOrithm (ROMEO).
     Magnetic Resonance in Medicine. https://doi.org/10.1002/mrm.28563
 
+    If cache_field_maps is set, the field maps of the last few inputs loaded from disk are cached (see
+    FMAP_CACHE_SIZE), so calling this again on the same files with only a different total readout time or
+    phase encoding direction skips the unwrapping (the cache is not used when debug is set). Use
+    clear_field_map_cache to free the cache.
+
     Parameters
     ----------
     phase : List[nib.Nifti1Image]
         Phases to unwrap
     mag : List[nib.Nifti1Image]
         Magnitudes associated with each phase
-    TEs : Union[List[float], Tuple[float]]
+    TEs : Union[List[float], Tuple[float], npt.NDArray[np.float32]]
         Echo times associated with each phase (in milliseconds)
     total_readout_time : float
         Total readout time (in seconds)
@@ -59,6 +117,25 @@ def medic(
         Number of CPUs to use, by default 4
     debug : bool, optional
         Whether to save intermediate files, by default False
+    wrap_limit : bool, optional
+        Turns off some heuristics for phase unwrapping, by default False
+    mask : nib.Nifti1Image, optional
+        Boolean mask (same shape and affine as the phase images) of voxels to unwrap, voxels outside of the
+        mask are skipped by the phase unwrapping. Only used if automask is False, by default None (which means
+        all voxels)
+    automask : bool, optional
+        Automatically compute a brain mask for each frame from the magnitude and phase data, and only unwrap
+        voxels inside of it (ignores the mask option), by default True
+    unwrap_method : str, optional
+        Phase unwrapping algorithm to use, either "romeo" or "dct_wls" (a weighted least squares method that
+        uses fast transforms, see warpkit.unwrap.unwrap_phase_dct_wls), by default "romeo"
+    chunk_size : int, optional
+        Number of frames to convert/invert at a time after the field maps are computed, by default 32.
+        Lower values reduce peak memory usage.
+    cache_field_maps : bool, optional
+        Cache the distorted space field maps (for inputs loaded from files), and reuse them on later calls with
+        the same inputs and unwrapping options, by default False. Note the cache holds up to FMAP_CACHE_SIZE
+        field map volumes in memory until clear_field_map_cache is called. The cache is not used in debug mode.
 
     Returns
     -------
@@ -69,67 +146,126 @@ def medic(
     nib.Nifti1Image
         Field maps in Hz (undistorted space)
     """
-    # make sure affines/shapes are all correct
-    for p1, m1 in zip(phase, mag):
-        for p2, m2 in zip(phase, mag):
-            if not (
-                np.allclose(p1.affine, p2.affine, rtol=1e-3, atol=1e-3)
-                and np.allclose(m1.affine, m2.affine, rtol=1e-3, atol=1e-3)
-                and p1.shape == p2.shape
-                and m1.shape == m2.shape
-            ):
-                print(p1.affine, p2.affine)
-                print(p1.affine - p2.affine)
-                print(p1.shape, p2.shape)
-                print(m1.affine, m2.affine)
-                print(m1.affine - m2.affine)
-                print(m1.shape, m2.shape)
-                raise ValueError("Affines and shapes must match")
-
-    # unwrap phase and compute field maps
-    try:
-        field_maps_native = unwrap_and_compute_field_maps(
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+
+    # make sure affines/shapes are all correct (compare all echoes against the first echo)
+    if not (
+        len({p.shape for p in phase}) == 1
+        and len({m.shape for m in mag}) == 1
+        and affines_match(phase, rtol=1e-3, atol=1e-3)
+        and affines_match(mag, rtol=1e-3, atol=1e-3)
+    ):
+        phase_affines = np.stack([p.affine for p in phase])
+        mag_affines = np.stack([m.affine for m in mag])
+        print(phase_affines)
+        print(phase_affines - phase_affines[0])
+        print([p.shape for p in phase])
+        print(mag_affines)
+        print(mag_affines - mag_affines[0])
+        print([m.shape for m in mag])
+        raise ValueError("Affines and shapes must match")
+
+    # unwrap phase and compute field maps (reusing a cached result if requested and these inputs were seen recently)
+    cache_key = None
+    if cache_field_maps and not debug:
+        cache_key = _field_map_cache_key(
             phase,
             mag,
             TEs,
+            mask,
+            automask=automask,
             border_size=border_size,
             border_filt=border_filt,
             svd_filt=svd_filt,
-            frames=frames,
-            n_cpus=n_cpus,
-            debug=debug,
+            frames=None if frames is None else tuple(int(f) for f in frames),
             wrap_limit=wrap_limit,
+            unwrap_method=unwrap_method,
         )
-    except IndexError as e:
-        raise IndexError(
-            "An IndexError was encountered while unwrapping phase images. "
-            "This tends to happen if you have noise frames left in your data. "
-            "You should remove these frames and try again. "
-            "Though, if you already have removed the noise frames from your data, "
-            "then I'm out of ideas... Sorry! "
-            "But, I'm just a error message that was written to anticipate a common "
-            "error after all, not a psychic! "
-            ":("
-        ) from e
-
-    # convert to displacement maps (these are in distorted space)
-    inv_displacement_maps = field_maps_to_displacement_maps(
-        field_maps_native, total_readout_time, phase_encoding_direction
-    )
+    if cache_key is not None and cache_key in _FMAP_CACHE:
+        logging.info("Using cached field maps...")
+        _FMAP_CACHE.move_to_end(cache_key)
+        # return a copy, so changes made by the caller don't leak into the cache
+        field_maps_native = _copy_image(_FMAP_CACHE[cache_key])
+    else:
+        try:
+            field_maps_native = unwrap_and_compute_field_maps(
+                phase,
+                mag,
+                TEs,
+                mask=mask,
+                automask=automask,
+                border_size=border_size,
+                border_filt=border_filt,
+                svd_filt=svd_filt,
+                frames=frames,
+                n_cpus=n_cpus,
+                debug=debug,
+                wrap_limit=wrap_limit,
+                unwrap_method=unwrap_method,
+            )
+        except IndexError as e:
+            raise IndexError(
+                "An IndexError was encountered while unwrapping phase images. "
+                "This tends to happen if you have noise frames left in your data. "
+                "You should remove these frames and try again. "
+                "Though, if you already have removed the noise frames from your data, "
+                "then I'm out of ideas... Sorry! "
+                "But, I'm just a error message that was written to anticipate a common "
+                "error after all, not a psychic! "
+                ":("
+            ) from e
+        if cache_key is not None:
+            # store a copy, since the returned image may be modified by the caller
+            _FMAP_CACHE[cache_key] = _copy_image(field_maps_native)
+            while len(_FMAP_CACHE) > FMAP_CACHE_SIZE:
+                _FMAP_CACHE.popitem(last=False)
 
-    # invert displacement maps (these are in undistorted space)
-    displacement_maps = invert_displacement_maps(inv_displacement_maps, phase_encoding_direction)
+    # allocate the undistorted space outputs, these are filled in chunks of frames below
+    n_frames = field_maps_native.shape[-1]
+    displacement_map_data = np.zeros(field_maps_native.shape, dtype=np.float32)
+    field_map_data = np.zeros(field_maps_native.shape, dtype=np.float32)
 
-    # convert correction maps back to undistorted space field map
-    field_maps = displacement_maps_to_field_maps(
-        displacement_maps, total_readout_time, phase_encoding_direction, flip_sign=True
-    )
+    # the conversions and inversion are independent per frame, so only chunk_size frames of
+    # intermediates are ever held in memory at once (the inversion pool is shared by all chunks, and is sized
+    # to the most frames a chunk can have, falling back to running in process when that is a single frame)
+    with create_executor(max(1, min(n_cpus, n_frames, chunk_size)), "process") as executor:
+        for start in range(0, n_frames, chunk_size):
+            frame_slice = slice(start, start + chunk_size)
+            field_maps_native_chunk = field_maps_native.slicer[..., frame_slice]
+
+            # convert to displacement maps (these are in distorted space)
+            inv_displacement_maps = field_maps_to_displacement_maps(
+                field_maps_native_chunk, total_readout_time, phase_encoding_direction
+            )
+
+            # invert displacement maps (these are in undistorted space)
+            displacement_maps_chunk = invert_displacement_maps(
+                inv_displacement_maps, phase_encoding_direction, executor=executor
+            )
+
+            # the distorted space displacement maps are no longer needed, free them before allocating the field maps
+            del inv_displacement_maps
+
+            # convert correction maps back to undistorted space field map
+            field_maps_chunk = displacement_maps_to_field_maps(
+                displacement_maps_chunk, total_readout_time, phase_encoding_direction, flip_sign=True
+            )
+
+            # store the chunk in the output arrays
+            displacement_map_data[..., frame_slice] = displacement_maps_chunk.dataobj
+            field_map_data[..., frame_slice] = field_maps_chunk.dataobj
+            del displacement_maps_chunk, field_maps_chunk
+
+    # form the output images
+    displacement_maps = nib.Nifti1Image(displacement_map_data, field_maps_native.affine, field_maps_native.header)
+    field_maps = nib.Nifti1Image(field_map_data, field_maps_native.affine, field_maps_native.header)
 
     # check if we need to flip sign of field maps (this is done by comparing sign of correlation between
     # native and undistorted field maps)
     if np.corrcoef(field_maps.dataobj[..., 0].ravel(), field_maps_native.dataobj[..., 0].ravel())[0, 1] < 0:
-        field_map_data = field_maps.get_fdata() * -1
-        field_maps = nib.Nifti1Image(field_map_data, field_maps.affine, field_maps.header)
+        # field_map_data was allocated above and backs field_maps, so we can flip it in place
+        np.negative(field_map_data, out=field_map_data)
 
     # return correction maps
     return field_maps_native, displacement_maps, field_maps
@@ -1,7 +1,9 @@
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import nibabel as nib
+import numpy as np
 
 from warpkit.distortion import medic
 from warpkit.utilities import setup_logging
@@ -19,6 +21,12 @@ def main():
     parser.add_argument("-n", "--n_cpus", type=int, default=4, help="Number of CPUs to use.")
     parser.add_argument("--debug", action="store_true", help="Debug mode")
     parser.add_argument("--wrap_limit", action="store_true", help="Turns off some heuristics for phase unwrapping")
+    parser.add_argument(
+        "--out_dtype",
+        choices=["float32", "int16"],
+        help="Data type to save the field maps and displacement maps as (int16 is scaled, using half the space of "
+        "float32). By default, the data type of the input phase data is used.",
+    )
 
     # parse arguments
     args = parser.parse_args()
@@ -29,62 +37,91 @@ def main():
     # log arguments
     print(f"medic: {args}")
 
-    # load magnitude and phase data
-    mag_data = [nib.load(m) for m in args.magnitude]
-    phase_data = [nib.load(p) for p in args.phase]
+    # load and validate the metadata first, so we fail before reading any of the (large) image data
+    def load_json(json_file):
+        with open(json_file, "r") as f:
+            return json.load(f)
 
-    # if noiseframes specified, remove them
-    if args.noiseframes > 0:
-        print(f"Removing {args.noiseframes} noise frames from the end of each file...")
-        mag_data = [nib.Nifti1Image(m.dataobj[..., : -args.noiseframes], m.affine, m.header) for m in mag_data]
-        phase_data = [nib.Nifti1Image(p.dataobj[..., : -args.noiseframes], p.affine, p.header) for p in phase_data]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(args.metadata), args.n_cpus))) as executor:
+        metadata_dicts = list(executor.map(load_json, args.metadata))
 
     # get metadata
     echo_times = []
     total_readout_time = None
     phase_encoding_direction = None
-    for n, j in enumerate(args.metadata):
-        with open(j, "r") as f:
-            metadata = json.load(f)
-            echo_times.append(metadata["EchoTime"] * 1000)
+    for n, metadata in enumerate(metadata_dicts):
+        if "EchoTime" not in metadata:
+            raise ValueError(f"Could not find EchoTime in metadata: {args.metadata[n]}")
+        echo_times.append(metadata["EchoTime"])
         if n == 0:
-            total_readout_time = metadata["TotalReadoutTime"]
-            phase_encoding_direction = metadata["PhaseEncodingDirection"]
+            total_readout_time = metadata.get("TotalReadoutTime")
+            phase_encoding_direction = metadata.get("PhaseEncodingDirection")
     if total_readout_time is None:
         raise ValueError("Could not find TotalReadoutTime in metadata.")
     if phase_encoding_direction is None:
         raise ValueError("Could not find PhaseEncodingDirection in metadata.")
 
-    # now run medic
+    # load magnitude and phase data, overlapping the file reads of each echo
+    n_files = len(args.magnitude) + len(args.phase)
+    with ThreadPoolExecutor(max_workers=max(1, min(n_files, args.n_cpus))) as executor:
+        # map submits every job up front, so all files are in flight before we wait on any of them
+        mag_results = executor.map(nib.load, args.magnitude)
+        phase_results = executor.map(nib.load, args.phase)
+        mag_data = list(mag_results)
+        phase_data = list(phase_results)
+
+    # if noiseframes specified, remove them
+    if args.noiseframes > 0:
+        print(f"Removing {args.noiseframes} noise frames from the end of each file...")
+        mag_data = [nib.Nifti1Image(m.dataobj[..., : -args.noiseframes], m.affine, m.header) for m in mag_data]
+        phase_data = [nib.Nifti1Image(p.dataobj[..., : -args.noiseframes], p.affine, p.header) for p in phase_data]
+
+    # convert echo times to ms
+    echo_times = (np.asarray(echo_times) * 1000).astype(np.float32)
+
+    # make sure echoes are in ascending echo time order (sort indices so the images are never compared)
+    order = np.argsort(echo_times, kind="stable")
+    echo_times = echo_times[order]
+    mag_data = [mag_data[i] for i in order]
+    phase_data = [phase_data[i] for i in order]
+
+    # now run medic (once, debug mode only changes the filtering options and saves intermediates)
+    border_size = 5
     if args.debug:
-        fmaps_native, dmaps, fmaps = medic(
-            phase_data,
-            mag_data,
-            echo_times,
-            total_readout_time,
-            phase_encoding_direction,
-            n_cpus=args.n_cpus,
-            border_filt=(1000, 1000),
-            svd_filt=1000,
-            debug=True,
-            wrap_limit=args.wrap_limit,
-        )
+        border_filt = (1000, 1000)
+        svd_filt = 1000
     else:
-        fmaps_native, dmaps, fmaps = medic(
-            phase_data,
-            mag_data,
-            echo_times,
-            total_readout_time,
-            phase_encoding_direction,
-            n_cpus=args.n_cpus,
-            svd_filt=10,
-            border_size=5,
-            wrap_limit=args.wrap_limit,
-        )
+        border_filt = (1, 5)
+        svd_filt = 10
+    fmaps_native, dmaps, fmaps = medic(
+        phase_data,
+        mag_data,
+        echo_times,
+        total_readout_time,
+        phase_encoding_direction,
+        n_cpus=args.n_cpus,
+        border_size=border_size,
+        border_filt=border_filt,
+        svd_filt=svd_filt,
+        debug=args.debug,
+        wrap_limit=args.wrap_limit,
+    )
 
     # save the fmaps and dmaps to file
     print("Saving field maps and displacement maps to file...")
-    fmaps_native.to_filename(f"{args.out_prefix}_fieldmaps_native.nii")
-    dmaps.to_filename(f"{args.out_prefix}_displacementmaps.nii")
-    fmaps.to_filename(f"{args.out_prefix}_fieldmaps.nii")
+    outputs = [
+        (fmaps_native, f"{args.out_prefix}_fieldmaps_native.nii"),
+        (dmaps, f"{args.out_prefix}_displacementmaps.nii"),
+        (fmaps, f"{args.out_prefix}_fieldmaps.nii"),
+    ]
+    # set the output data type if requested
+    if args.out_dtype is not None:
+        for img, _ in outputs:
+            img.set_data_dtype(args.out_dtype)
+    # the writes are independent (and I/O bound), so do them concurrently
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        futures = [executor.submit(img.to_filename, filename) for img, filename in outputs]
+        # re-raise any errors encountered while writing
+        for future in futures:
+            future.result()
     print("Done.")
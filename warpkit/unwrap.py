@@ -5,6 +5,7 @@ from typing import List, Tuple, Union, cast
 import nibabel as nib
 import numpy as np
 import numpy.typing as npt
+from scipy.fft import dctn, idctn
 from scipy.ndimage import (
     binary_dilation,
     binary_erosion,
@@ -19,6 +20,7 @@ from .concurrency import run_executor
 from .julia import JuliaContext
 from .model import weighted_regression
 from .utilities import (
+    affines_match,
     corr2_coeff,
     create_brain_mask,
     get_largest_connected_component,
@@ -27,6 +29,18 @@ from .utilities import (
 
 FMAP_PROPORTION_HEURISTIC = 0.25
 FMAP_AMBIGUIOUS_HEURISTIC = 0.5
+UNWRAP_METHODS = ("romeo", "dct_wls")
+
+
+def _add_axis(img: nib.Nifti1Image) -> nib.Nifti1Image:
+    """Add a trailing frame axis to a 3D image without decoding it to float64."""
+    data = np.asanyarray(img.dataobj)
+    return nib.Nifti1Image(data.reshape(data.shape + (1,)), img.affine, img.header)
+
+
+def _wrap(data: npt.NDArray) -> npt.NDArray:
+    """Wrap data to [-pi, pi)."""
+    return (data + np.pi) % (2 * np.pi) - np.pi
 
 
 def reject_outliers(data, m=2.0):
@@ -198,6 +212,131 @@ def mcpc_3d_s(
     return np.angle(np.exp(1j * (phase0 - ((TE0 * unwrapped_diff) / (TE1 - TE0))))), unwrapped_diff
 
 
+def _forward_difference(data: npt.NDArray, axis: int) -> npt.NDArray:
+    """Forward difference along an axis (zero on the last index, i.e. Neumann boundary)."""
+    diff = np.zeros_like(data)
+    index = [slice(None)] * data.ndim
+    index[axis] = slice(0, -1)
+    diff[tuple(index)] = np.diff(data, axis=axis)
+    return diff
+
+
+def _backward_difference(data: npt.NDArray, axis: int) -> npt.NDArray:
+    """Backward difference along an axis (the negative adjoint of _forward_difference)."""
+    diff = data.copy()
+    index = [slice(None)] * data.ndim
+    index[axis] = slice(1, None)
+    prev_index = [slice(None)] * data.ndim
+    prev_index[axis] = slice(0, -1)
+    diff[tuple(index)] -= data[tuple(prev_index)]
+    return diff
+
+
+def _edge_weights(weights: npt.NDArray, axis: int) -> npt.NDArray:
+    """Weight of each voxel-to-next-voxel edge along an axis (min of the two voxel weights)."""
+    edge_weights = np.zeros_like(weights)
+    index = [slice(None)] * weights.ndim
+    index[axis] = slice(0, -1)
+    next_index = [slice(None)] * weights.ndim
+    next_index[axis] = slice(1, None)
+    edge_weights[tuple(index)] = np.minimum(weights[tuple(index)], weights[tuple(next_index)])
+    return edge_weights
+
+
+def _weighted_laplacian(data: npt.NDArray, edge_weights: List[npt.NDArray]) -> npt.NDArray:
+    """Apply the weighted discrete Laplacian (div(W grad(data))) with Neumann boundaries."""
+    return sum(_backward_difference(w * _forward_difference(data, axis), axis) for axis, w in enumerate(edge_weights))
+
+
+def _solve_poisson_dct(rho: npt.NDArray, workers: int = -1) -> npt.NDArray:
+    """Solve the unweighted discrete Poisson equation with Neumann boundaries using the DCT."""
+    rho_hat = dctn(rho, type=2, norm="ortho", workers=workers)
+
+    # eigenvalues of the discrete Laplacian in the DCT basis
+    eigenvalues = np.zeros(rho.shape, dtype=rho.dtype)
+    for axis, n in enumerate(rho.shape):
+        shape = [1] * rho.ndim
+        shape[axis] = n
+        eigenvalues = eigenvalues + (2 * np.cos(np.pi * np.arange(n) / n) - 2).reshape(shape)
+
+    # the solution is only defined up to a constant, so zero out the DC term
+    eigenvalues.flat[0] = 1
+    phi_hat = rho_hat / eigenvalues
+    phi_hat.flat[0] = 0
+    return idctn(phi_hat, type=2, norm="ortho", workers=workers)
+
+
+def unwrap_phase_dct_wls(
+    phase: npt.NDArray[np.float32],
+    weight: npt.NDArray[np.float32],
+    n_iter: int = 16,
+    tol: float = 1e-6,
+    workers: int = -1,
+) -> npt.NDArray[np.float32]:
+    """Unwraps a single echo of phase data with a weighted least squares method.
+
+    This solves the weighted least squares unwrapping problem with preconditioned conjugate gradients,
+    using a DCT based Poisson solver as the preconditioner. Each iteration is O(N log N), so this is a
+    fast alternative to path-following unwrappers for large volumes. To learn more, see the following paper:
+
+    Ghiglia, D.C., Romero, L.A., 1994.
+    Robust two-dimensional weighted and unweighted phase unwrapping that uses fast transforms and iterative methods.
+    Journal of the Optical Society of America A. https://doi.org/10.1364/JOSAA.11.000107
+
+    Parameters
+    ----------
+    phase : npt.NDArray[np.float32]
+        Wrapped phase data in radians with shape (x, y, z)
+    weight : npt.NDArray[np.float32]
+        Non-negative weights with shape (x, y, z) (e.g. magnitude data, zero outside of the mask)
+    n_iter : int, optional
+        Maximum number of conjugate gradient iterations, by default 16
+    tol : float, optional
+        Relative residual tolerance to stop iterating at, by default 1e-6
+    workers : int, optional
+        Number of workers to use for the DCT, by default -1 (all CPUs)
+
+    Returns
+    -------
+    npt.NDArray[np.float32]
+        unwrapped phase in radians
+    """
+    phase = phase.astype(np.float64)
+    weight = weight.astype(np.float64)
+    if weight.max() > 0:
+        weight /= weight.max()
+    edge_weights = [_edge_weights(weight, axis) for axis in range(phase.ndim)]
+
+    # the right hand side is the weighted divergence of the wrapped phase gradients
+    rhs = sum(
+        _backward_difference(w * _wrap(_forward_difference(phase, axis)), axis) for axis, w in enumerate(edge_weights)
+    )
+    rhs_norm = np.linalg.norm(rhs)
+
+    # preconditioned conjugate gradients
+    solution = np.zeros_like(phase)
+    residual = rhs.copy()
+    direction = np.zeros_like(phase)
+    rz_old = 0.0
+    for k in range(n_iter):
+        if rhs_norm == 0 or np.linalg.norm(residual) <= tol * rhs_norm:
+            break
+        z = _solve_poisson_dct(residual, workers)
+        rz = np.vdot(residual, z)
+        direction = z if k == 0 else z + (rz / rz_old) * direction
+        rz_old = rz
+        laplacian_direction = _weighted_laplacian(direction, edge_weights)
+        alpha = rz / np.vdot(direction, laplacian_direction)
+        solution += alpha * direction
+        residual -= alpha * laplacian_direction
+
+    # the least squares solution is only defined up to a constant, so align it to the wrapped phase
+    solution += np.angle(np.sum(weight * np.exp(1j * (phase - solution))))
+
+    # make the solution congruent with the wrapped phase (differ only by integer multiples of 2 pi)
+    return (phase + 2 * np.pi * np.round((solution - phase) / (2 * np.pi))).astype(np.float32)
+
+
 def unwrap_phase(
     phase_data: npt.NDArray[np.float32],
     mag_data: npt.NDArray[np.float32],
@@ -208,6 +347,8 @@ def unwrap_phase(
     idx: Union[int, None] = None,
     wrap_limit: bool = False,
     debug: bool = False,
+    unwrap_method: str = "romeo",
+    fft_workers: int = -1,
 ) -> Tuple[npt.NDArray[np.float32], npt.NDArray[np.int8]]:
     """Unwraps the phase for a single frame of ME-EPI data.
 
@@ -227,6 +368,11 @@ def unwrap_phase(
         Number of extra dilations (or erosions if negative) to perform, by default 3
     idx : int, optional
         Index of the frame being processed for verbosity, by default None
+    unwrap_method : str, optional
+        Phase unwrapping algorithm to use, either "romeo" or "dct_wls" (see unwrap_phase_dct_wls),
+        by default "romeo"
+    fft_workers : int, optional
+        Number of threads to use for the FFTs of the "dct_wls" method, by default -1 (all CPUs)
 
     Returns
     -------
@@ -298,17 +444,33 @@ def unwrap_phase(
     phase_data -= phase_offset[..., np.newaxis]
 
     # unwrap the phase data
-    unwrapped = JULIA.romeo_unwrap4D(  # type: ignore
-        phase=phase_data,
-        TEs=TEs,
-        weights="romeo",
-        mag=mag_data,
-        mask=mask_data,
-        correct_global=True,
-        maxseeds=1,
-        merge_regions=False,
-        correct_regions=False,
-    )
+    if unwrap_method == "dct_wls":
+        # unwrap each echo separately, weighted by the magnitude inside of the mask
+        unwrapped = np.stack(
+            [
+                unwrap_phase_dct_wls(phase_data[..., i_echo], mag_data[..., i_echo] * mask_data, workers=fft_workers)
+                for i_echo in range(phase_data.shape[-1])
+            ],
+            axis=-1,
+        )
+        # global correction, so the median phase in the mask of each echo lies in [-pi, pi]
+        # (the echoes are made consistent with each other by the global mode correction below)
+        # skip this if the mask is empty, since the median would be NaN
+        if mask_data.any():
+            for i_echo in range(unwrapped.shape[-1]):
+                unwrapped[..., i_echo] -= 2 * np.pi * np.round(np.median(unwrapped[mask_data, i_echo]) / (2 * np.pi))
+    else:
+        unwrapped = JULIA.romeo_unwrap4D(  # type: ignore
+            phase=phase_data,
+            TEs=TEs,
+            weights="romeo",
+            mag=mag_data,
+            mask=mask_data,
+            correct_global=True,
+            maxseeds=1,
+            merge_regions=False,
+            correct_regions=False,
+        )
 
     # global mode correction
     # this computes the global mode offset for the first echo then tries to find the offset
@@ -602,6 +764,7 @@ def unwrap_and_compute_field_maps(
     n_cpus: int = 4,
     debug: bool = False,
     wrap_limit: bool = False,
+    unwrap_method: str = "romeo",
 ) -> nib.Nifti1Image:
     """Unwrap phase of data weighted by magnitude data and compute field maps. This makes a call
     to the ROMEO phase unwrapping algorithm for each frame. To learn more about ROMEO, see this paper:
@@ -619,7 +782,7 @@ def unwrap_and_compute_field_maps(
     TEs : Union[List[float], Tuple[float], npt.NDArray[np.float32]]
         Echo times associated with each phase (in ms)
     mask : nib.Nifti1Image, optional
-        Boolean mask, by default None
+        Boolean mask with the same shape and affine as the phase images, by default None
     automask : bool, optional
         Automatically generate a mask (ignore mask option), by default True
     border_size : int, optional
@@ -634,12 +797,20 @@ def unwrap_and_compute_field_maps(
         Number of CPUs to use, by default 4
     debug : bool, optional
         Debug mode, by default False
+    wrap_limit : bool, optional
+        Turns off some heuristics for phase unwrapping, by default False
+    unwrap_method : str, optional
+        Phase unwrapping algorithm to use, either "romeo" or "dct_wls" (weighted least squares, see
+        unwrap_phase_dct_wls), by default "romeo"
 
     Returns
     -------
     nib.Nifti1Image
         Field maps in Hz
     """
+    if unwrap_method not in UNWRAP_METHODS:
+        raise ValueError(f"unwrap_method must be one of {UNWRAP_METHODS}.")
+
     # check TEs if < 0.1, tell user they probably need to convert to ms
     if np.min(TEs) < 0.1:
         logging.warning(
@@ -649,28 +820,25 @@ def unwrap_and_compute_field_maps(
     # convert TEs to np array
     TEs = cast(npt.NDArray[np.float32], np.array(TEs))
 
-    # make sure affines/shapes are all correct
-    for p1, m1 in zip(phase, mag):
-        for p2, m2 in zip(phase, mag):
-            if not (
-                np.allclose(p1.affine, p2.affine, rtol=1e-3, atol=1e-3)
-                and np.allclose(p1.shape, p2.shape, rtol=1e-3, atol=1e-3)
-                and np.allclose(m1.affine, m2.affine, rtol=1e-3, atol=1e-3)
-                and np.allclose(m1.shape, m2.shape, rtol=1e-3, atol=1e-3)
-                and np.allclose(p1.affine, m1.affine, rtol=1e-3, atol=1e-3)
-                and np.allclose(p1.shape, m1.shape, rtol=1e-3, atol=1e-3)
-                and np.allclose(p2.affine, m2.affine, rtol=1e-3, atol=1e-3)
-                and np.allclose(p2.shape, m2.shape, rtol=1e-3, atol=1e-3)
-            ):
-                raise ValueError("Affines/Shapes of images do not all match.")
+    # make sure affines/shapes are all correct (every phase and magnitude image must match the first phase image)
+    if not (len({img.shape for img in [*phase, *mag]}) == 1 and affines_match([*phase, *mag], rtol=1e-3, atol=1e-3)):
+        raise ValueError("Affines/Shapes of images do not all match.")
+
+    # a user supplied mask must be on the same grid as the phase images
+    if mask is not None:
+        if not (mask.shape == phase[0].shape and affines_match([phase[0], mask], rtol=1e-3, atol=1e-3)):
+            raise ValueError("Affine/Shape of mask does not match the phase images.")
 
     # check if data is 4D or 3D
     if len(phase[0].shape) == 3:
-        # set total number of frames to 1
+        # there is only a single frame to process
+        frames = [0]
         n_frames = 1
         # convert data to 4D
-        phase = [nib.Nifti1Image(p.get_fdata()[..., np.newaxis], p.affine, p.header) for p in phase]
-        mag = [nib.Nifti1Image(m.get_fdata()[..., np.newaxis], m.affine, m.header) for m in mag]
+        phase = [_add_axis(p) for p in phase]
+        mag = [_add_axis(m) for m in mag]
+        if mask is not None:
+            mask = _add_axis(mask)
     elif len(phase[0].shape) == 4:
         # if frames is None, set it to all frames
         if frames is None:
@@ -700,13 +868,21 @@ def unwrap_and_compute_field_maps(
         header = phase[0].header
 
     # allocate mask if needed
-    if not mask:
+    if mask is None:
         mask = SimpleNamespace()
         if automask:  # if we are automasking use a fake array that plays nice with the logic
             mask.dataobj = np.ones((1, 1, 1, phase[0].shape[-1]))
         else:
             mask.dataobj = np.ones(phase[0].shape)
 
+    # split the n_cpus budget between the processes that unwrap frames in parallel and the threaded
+    # FFTs within each frame (only used by dct_wls), so the two levels don't oversubscribe
+    frame_workers = max(1, min(n_cpus, n_frames))
+    fft_workers = max(1, n_cpus // frame_workers)
+    # but always unwrap in a process pool when using more than one CPU, even for a single frame, since starting
+    # a JuliaContext in this process would crash any process that is forked from it later
+    pool_workers = frame_workers if n_cpus == 1 else max(2, frame_workers)
+
     # write a function to iterate over each frame for phase unwrapping
     def phase_iterator(phase, mag, TEs, mask, frames, automask, automask_dilation):
         # note that I separate out idx and frame_idx for the case when the user wants to process a subset of
@@ -723,24 +899,39 @@ def unwrap_and_compute_field_maps(
             # get the min and max phase value
             min_phases.append(phase_data.min())
             max_phases.append(phase_data.max())
-        min_phase = mode(min_phases, keepdims=False).mode
-        max_phase = mode(max_phases, keepdims=False).mode
+        # keep these as python floats so they don't promote the float32 frame data during rescaling
+        min_phase = float(mode(min_phases, keepdims=False).mode)
+        max_phase = float(mode(max_phases, keepdims=False).mode)
         logging.info("Estimated min phase: %f", min_phase)
         logging.info("Estimated max phase: %f", max_phase)
 
         for idx, frame_idx in enumerate(frames):
             # get the phase and magnitude data from each echo
+            # (frames are read in their stored dtype, e.g. int16, and cast to float32 once before rescaling,
+            # so the rescaling never runs in float64)
             phase_data: npt.NDArray[np.float32] = rescale_phase(
-                np.stack([p.dataobj[..., frame_idx] for p in phase], axis=-1),
+                np.stack([p.dataobj[..., frame_idx] for p in phase], axis=-1).astype(np.float32),
                 min=min_phase,
                 max=max_phase,
-            ).astype(np.float32)
+            )
             mag_data: npt.NDArray[np.float32] = np.stack([m.dataobj[..., frame_idx] for m in mag], axis=-1).astype(
                 np.float32
             )
             mask_data = cast(npt.NDArray[np.bool_], mask.dataobj[..., frame_idx].astype(bool))
             TEs = TEs.astype(np.float32)
-            yield (phase_data, mag_data, TEs, mask_data, automask, automask_dilation, idx, wrap_limit, debug)
+            yield (
+                phase_data,
+                mag_data,
+                TEs,
+                mask_data,
+                automask,
+                automask_dilation,
+                idx,
+                wrap_limit,
+                debug,
+                unwrap_method,
+                fft_workers,
+            )
 
     def save_unwrapped_and_mask(idx, result):
         # get the unwrapped image
@@ -750,7 +941,7 @@ def unwrap_and_compute_field_maps(
 
     # unwrap the phase of each frame
     run_executor(
-        ncpus=n_cpus,
+        ncpus=pool_workers,
         type="process",
         fn=unwrap_phase,
         iterator=phase_iterator(phase, mag, TEs, mask, frames, automask, border_size),
@@ -791,12 +982,13 @@ def unwrap_and_compute_field_maps(
         nib.Nifti1Image(new_masks, phase[0].affine, phase[0].header).to_filename("masks.nii")
 
     # compute field maps on temporally consistent unwrapped phase
-    def field_map_iterator(field_maps, unwrapped, mag, TEs):
+    def field_map_iterator(field_maps, unwrapped, mag, TEs, frames):
         logging.info(f"Running field map computation...")
         # convert TEs to a matrix
         TEs_mat = TEs[:, np.newaxis]
-        for frame_num in range(unwrapped.shape[-1]):
-            yield (unwrapped[..., frame_num], mag, TEs.shape[0], TEs_mat, frame_num)
+        # unwrapped is indexed by processed frame, but the magnitude needs the original frame index
+        for idx, frame_idx in enumerate(frames):
+            yield (unwrapped[..., idx], mag, TEs.shape[0], TEs_mat, frame_idx)
 
     def post_field_map(idx, result):
         logging.info(f"Field map computation for frame {idx} complete.")
@@ -806,7 +998,7 @@ def unwrap_and_compute_field_maps(
         ncpus=n_cpus,
         type="thread",
         fn=compute_field_map,
-        iterator=field_map_iterator(field_maps, unwrapped, mag, TEs),
+        iterator=field_map_iterator(field_maps, unwrapped, mag, TEs, frames),
         post_fn=post_field_map,
     )
 
@@ -824,4 +1016,5 @@ def unwrap_and_compute_field_maps(
     )
 
     # return the field map as a nifti image
-    return nib.Nifti1Image(field_maps[..., frames], phase[0].affine, phase[0].header)
+    # (field_maps is already indexed by processed frame, so it is returned as is rather than indexed by frames)
+    return nib.Nifti1Image(field_maps, phase[0].affine, phase[0].header)
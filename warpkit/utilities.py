@@ -1,7 +1,8 @@
 import logging
 import sys
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import Any, Tuple, cast
+from typing import Any, Optional, Sequence, Tuple, cast
 
 import nibabel as nib
 import numpy as np
@@ -26,6 +27,7 @@ from . import (
 from . import invert_displacement_field as invert_displacement_field_cpp  # type: ignore
 from . import invert_displacement_map as invert_displacement_map_cpp  # type: ignore
 from . import resample as resample_cpp  # type: ignore
+from .concurrency import run_executor
 
 # map axis names to axis codes
 AXIS_MAP = {"x": 0, "y": 1, "z": 2, "x-": 0, "y-": 1, "z-": 2, "i": 0, "j": 1, "k": 2, "i-": 0, "j-": 1, "k-": 2}
@@ -116,6 +118,29 @@ def corr2_coeff(A: npt.NDArray, B: npt.NDArray) -> npt.NDArray:
     return np.dot(A_mA, B_mB.T) / np.sqrt(np.dot(ssA, ssB))
 
 
+def affines_match(imgs: Sequence[nib.Nifti1Image], rtol: float = 1e-5, atol: float = 1e-8) -> bool:
+    """Check that the affines of a set of images all match the first image.
+
+    The affines are stacked and compared against the first one in a single np.allclose call.
+
+    Parameters
+    ----------
+    imgs : Sequence[nib.Nifti1Image]
+        Images to compare
+    rtol : float, optional
+        Relative tolerance, by default 1e-5
+    atol : float, optional
+        Absolute tolerance, by default 1e-8
+
+    Returns
+    -------
+    bool
+        True if all affines match
+    """
+    affines = np.stack([img.affine for img in imgs])
+    return bool(np.allclose(affines, affines[0], rtol=rtol, atol=atol))
+
+
 def rescale_phase(data: npt.NDArray[Any], min: int = -4096, max: int = 4096) -> npt.NDArray[Any]:
     """Rescale phase data to [-pi, pi]
 
@@ -244,7 +269,7 @@ def field_maps_to_displacement_maps(
         voxel_size *= -1
 
     # convert field maps to displacement maps
-    data = field_maps.get_fdata()
+    data = field_maps.get_fdata(dtype=np.float32, caching="unchanged")
 
     new_data = data * total_readout_time * voxel_size
 
@@ -292,7 +317,7 @@ def displacement_maps_to_field_maps(
         voxel_size *= -1
 
     # convert displacement maps to field maps
-    data = displacement_maps.get_fdata()
+    data = displacement_maps.get_fdata(dtype=np.float32, caching="unchanged")
     new_data = data / (total_readout_time * voxel_size)
     if flip_sign:
         new_data *= -1
@@ -332,7 +357,7 @@ def displacement_map_to_field(
     if len(displacement_map.shape) == 4:
         data = np.asarray(displacement_map.dataobj[..., frame])
     else:  # otherwise just get the data
-        data = displacement_map.get_fdata()
+        data = displacement_map.get_fdata(dtype=np.float32, caching="unchanged")
 
     # get affine and header info
     affine = displacement_map.affine
@@ -401,8 +426,57 @@ def get_ras_orient_transform(img: nib.Nifti1Image) -> Tuple[np.ndarray, np.ndarr
     return get_x_orient_transform(img, "RAS")
 
 
+def invert_displacement_map_frame(
+    data: npt.NDArray,
+    translations: npt.NDArray,
+    rotations: npt.NDArray,
+    zooms: npt.NDArray,
+    axis_code: int,
+    verbose: bool = False,
+) -> npt.NDArray[np.float32]:
+    """Invert a single frame of a displacement map (in RAS orientation)
+
+    Parameters
+    ----------
+    data : npt.NDArray
+        Displacement map data for a single frame in mm
+    translations : npt.NDArray
+        Translation component of the affine
+    rotations : npt.NDArray
+        Rotation component of the affine
+    zooms : npt.NDArray
+        Zoom component of the affine
+    axis_code : int
+        Axis code displacement map is along
+    verbose : bool, optional
+        Print debugging information, by default False
+
+    Returns
+    -------
+    npt.NDArray[np.float32]
+        Inverted displacement map for the frame in mm
+    """
+    # pad array with edge values so edge effects of inverse are avoided
+    mod_data = np.pad(data, pad_width=1)
+
+    return invert_displacement_map_cpp(
+        mod_data,
+        translations,
+        rotations,
+        zooms,
+        axis=axis_code,
+        verbose=verbose,
+    )[
+        1 : data.shape[0] + 1, 1 : data.shape[1] + 1, 1 : data.shape[2] + 1
+    ].astype(np.float32)
+
+
 def invert_displacement_maps(
-    displacement_maps: nib.Nifti1Image, axis: str = "y", verbose: bool = False
+    displacement_maps: nib.Nifti1Image,
+    axis: str = "y",
+    verbose: bool = False,
+    n_cpus: int = 1,
+    executor: Optional[Executor] = None,
 ) -> nib.Nifti1Image:
     """Invert displacement maps
 
@@ -414,6 +488,11 @@ def invert_displacement_maps(
         Axis displacement maps are along, by default "y"
     verbose : bool, optional
         Print debugging information, by default False
+    n_cpus : int, optional
+        Number of CPUs to use (frames are inverted in parallel), by default 1
+    executor : Executor, optional
+        Existing executor to invert the frames on (e.g. a process pool reused across calls),
+        by default None (which creates one with n_cpus processes)
 
     Returns
     -------
@@ -439,19 +518,24 @@ def invert_displacement_maps(
     # invert maps
     new_data = np.zeros(data.shape, dtype=np.float32)
     logging.info("Inverting displacement maps...")
-    for i_vol in range(data.shape[-1]):
-        logging.info(f"Processing frame: {i_vol}")
-        # pad array with edge values so edge effects of inverse are avoided
-        mod_data = np.pad(data[..., i_vol], pad_width=1)
-
-        new_data[..., i_vol] = invert_displacement_map_cpp(
-            mod_data,
-            translations,
-            rotations,
-            zooms,
-            axis=axis_code,
-            verbose=verbose,
-        )[1 : data.shape[0] + 1, 1 : data.shape[1] + 1, 1 : data.shape[2] + 1]
+
+    # each frame is inverted independently, the ITK inverse holds the GIL so we use processes
+    def frame_iterator():
+        for i_vol in range(data.shape[-1]):
+            logging.info(f"Processing frame: {i_vol}")
+            yield (np.asarray(data[..., i_vol]), translations, rotations, zooms, axis_code, verbose)
+
+    def store_frame(idx, result):
+        new_data[..., idx] = result
+
+    run_executor(
+        ncpus=n_cpus,
+        type="process",
+        fn=invert_displacement_map_frame,
+        iterator=frame_iterator(),
+        post_fn=store_frame,
+        executor=executor,
+    )
 
     # make new image in original orientation
     inv_displacement_maps = nib.Nifti1Image(